@@ -2,11 +2,6 @@
 import typing
 from enum import Enum
 import sys
-
-if sys.version_info < (3, 10):
-    from importlib_metadata import entry_points
-else:
-    from importlib.metadata import entry_points
 import functools
 
 __version__ = "0.4.2"
@@ -58,8 +53,63 @@ def SR_MHZ(num):
     return SR_KHZ(num) * 1000
 
 
+class MatchedMask:
+    """
+    Records which of the conditions passed to wait() matched. Bit ``k`` of ``mask``
+    is set when condition ``k`` matched. It indexes, iterates and compares like the
+    tuple of bools that libsigrokdecode provides.
+    """
+
+    __slots__ = ("mask", "count")
+
+    def __init__(self, mask: int, count: int):
+        self.mask = mask
+        self.count = count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return tuple(self)[index]
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("matched index out of range")
+        return (self.mask >> index) & 1 == 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self):
+        mask = self.mask
+        return ((mask >> i) & 1 == 1 for i in range(self.count))
+
+    def __eq__(self, other):
+        if isinstance(other, MatchedMask):
+            return self.mask == other.mask and self.count == other.count
+        try:
+            return tuple(self) == tuple(other)
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"MatchedMask({tuple(self)})"
+
+
 class Decoder:
-    # __init__() won't get called by subclasses
+    # __init__() won't get called by subclasses so per-instance state is set up in
+    # __new__() instead.
+
+    channels: typing.Tuple[typing.Dict[str, str], ...] = tuple()
+    optional_channels: typing.Tuple[typing.Dict[str, str], ...] = tuple()
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        self.callbacks = {}
+        self._sinks = {}
+        self.decoder_channel_to_data_channel = {}
+        self.one_to_one = True
+        self._remap_data = None
+        self._data_conds = {}
+        return self
 
     def register(self, output_type: OutputType, proto_id=None, meta=None) -> OutputType:
         """
@@ -91,16 +141,27 @@ class Decoder:
 
     def add_callback(self, output_type: OutputType, output_filter, fun) -> None:
         # print(output_type, output_filter, fun)
-        if not hasattr(self, "callbacks"):
-            self.callbacks = {}
-
         if output_type not in self.callbacks:
-            self.callbacks[output_type] = set()
-
-        self.callbacks[output_type].add((output_filter, fun))
+            self.callbacks[output_type] = []
+
+        self.callbacks[output_type].append((output_filter, fun))
+
+        # Resolve the filters now so put() doesn't have to. Annotation and binary
+        # callbacks are grouped by the annotation or binary index they accept.
+        callbacks = self.callbacks[output_type]
+        if output_type is OUTPUT_ANN or output_type is OUTPUT_BINARY:
+            if output_type is OUTPUT_ANN:
+                rows = getattr(self, "annotations", ())
+            else:
+                rows = getattr(self, "binary", ())
+            self._sinks[output_type] = [
+                tuple(cb for f, cb in callbacks if f is None or f == row[0])
+                for row in rows
+            ]
+        else:
+            self._sinks[output_type] = tuple(cb for _, cb in callbacks)
 
     def wait(self, conds=[]):
-        assert hasattr(self, "input")
         if isinstance(conds, dict):
             conds = [conds]
         if self.one_to_one:
@@ -108,56 +169,91 @@ class Decoder:
         else:
             data_conds = []
             for cond in conds:
-                data_cond = {}
-                for k in cond:
-                    if k == "skip":
-                        data_cond["skip"] = cond[k]
-                    else:
-                        data_cond[self.decoder_channel_to_data_channel[k]] = cond[k]
+                key = tuple(cond.items())
+                data_cond = self._data_conds.get(key)
+                if data_cond is None:
+                    data_cond = {}
+                    for k in cond:
+                        if k == "skip":
+                            data_cond["skip"] = cond[k]
+                        else:
+                            data_cond[self.decoder_channel_to_data_channel[k]] = cond[k]
+                    # Inputs may count skip conditions down in place so only cache
+                    # translations without one.
+                    if "skip" not in cond:
+                        self._data_conds[key] = data_cond
                 data_conds.append(data_cond)
 
         raw_data = self.input.wait(data_conds)
-        data = [None] * (
-            len(type(self).channels) + len(getattr(type(self), "optional_channels", []))
-        )
-        for decoder_channel in self.decoder_channel_to_data_channel:
-            data_channel = self.decoder_channel_to_data_channel[decoder_channel]
-            data[decoder_channel] = raw_data[data_channel]
+        if self._remap_data is None:
+            self._remap_data = self._compile_remap()
+        return self._remap_data(raw_data)
 
-        return tuple(data)
+    def _compile_remap(self):
+        """
+        Generate a function that picks this decoder's channels out of the input's
+        data, in decoder channel order with None for unassigned channels.
+        """
+        count = type(self)._total_channel_count()
+        channel_map = self.decoder_channel_to_data_channel
+        items = []
+        for i in range(count):
+            data_channel = channel_map.get(i)
+            if data_channel is None:
+                items.append("None")
+            else:
+                items.append(f"raw_data[{data_channel:d}]")
+        source = f"({''.join(item + ', ' for item in items)})"
+        if all(channel_map.get(i) == i for i in range(count)):
+            # Every channel is assigned in order so a tuple only needs truncating.
+            # Slicing is a C level call and returns the input's tuple itself when it
+            # has exactly this decoder's channels. Anything else is indexed so the
+            # result is always a tuple and short data raises IndexError.
+            source = (
+                f"raw_data[:{count:d}] if type(raw_data) is tuple"
+                f" and len(raw_data) >= {count:d} else {source}"
+            )
+        return eval(f"lambda raw_data: {source}")
 
     def put(
         self, startsample: int, endsample: int, output_id: OutputType, data: DataType
     ) -> None:
         # print(startsample, endsample, output_id, data)
-        if output_id not in self.callbacks:
+        sinks = self._sinks.get(output_id)
+        if sinks is None:
             return
-        for output_filter, cb in self.callbacks[output_id]:
-            if output_filter is not None:
-                if output_id == OUTPUT_ANN:
-                    annotation = self.annotations[data[0]]
-                    if annotation[0] != output_filter:
-                        continue
-                elif output_id == OUTPUT_BINARY:
-                    track = self.binary[data[0]]
-                    if track[0] != output_filter:
-                        continue
+        if output_id is OUTPUT_ANN or output_id is OUTPUT_BINARY:
+            sinks = sinks[data[0]]
+        for cb in sinks:
             cb(startsample, endsample, data)
 
     def set_channelnum(self, channelname: str, channelnum: int) -> None:
-        if not hasattr(self, "decoder_channel_to_data_channel"):
-            self.decoder_channel_to_data_channel = {}
-            self.one_to_one = True
-
-        if not hasattr(type(self), "optional_channels"):
-            type(self).optional_channels = tuple()
-        if not hasattr(type(self), "channels"):
-            type(self).channels = tuple()
-        for i, c in enumerate(type(self).channels + type(self).optional_channels):
-            if c["id"] == channelname:
-                self.decoder_channel_to_data_channel[i] = channelnum
-                self.one_to_one = self.one_to_one and i == channelnum
-                break
+        i = type(self)._channel_index_map().get(channelname)
+        if i is not None:
+            self.decoder_channel_to_data_channel[i] = channelnum
+            self.one_to_one = self.one_to_one and i == channelnum
+            self._remap_data = None
+            self._data_conds.clear()
+
+    @classmethod
+    def _total_channel_count(cls) -> int:
+        count = cls.__dict__.get("_channel_count")
+        if count is None:
+            count = len(cls.channels) + len(cls.optional_channels)
+            cls._channel_count = count
+        return count
+
+    @classmethod
+    def _channel_index_map(cls) -> typing.Dict[str, int]:
+        # Cached in the class's own __dict__ so subclasses don't share a parent's map.
+        index_map = cls.__dict__.get("_channel_indices")
+        if index_map is None:
+            index_map = {}
+            channels = tuple(cls.channels) + tuple(cls.optional_channels)
+            for i, c in enumerate(channels):
+                index_map.setdefault(c["id"], i)
+            cls._channel_indices = index_map
+        return index_map
 
     def has_channel(self, decoder_channel: int) -> bool:
         return decoder_channel in self.decoder_channel_to_data_channel
@@ -171,6 +267,9 @@ class Decoder:
         return self.input.matched
 
     def run(self, input_):
+        # Checked once here so wait(), samplenum and matched can use self.input as is.
+        if input_ is None:
+            raise ValueError("Decoder needs an input to run")
         self.input = input_
         try:
             self.decode()
@@ -181,16 +280,100 @@ class Decoder:
         pass
 
 
+@functools.lru_cache(maxsize=1)
+def _all_decoders():
+    """Map each installed decoder id to the entry points that provide it."""
+    # Imported here so decoders that only subclass Decoder don't pay for it.
+    if sys.version_info < (3, 10):
+        from importlib_metadata import entry_points
+    else:
+        from importlib.metadata import entry_points
+
+    decoders = {}
+    for entry_point in entry_points(group="pysigrok.decoders"):
+        decoders.setdefault(entry_point.name, []).append(entry_point)
+    return decoders
+
+
+@functools.lru_cache(maxsize=None)
 def get_decoder(decoder_id):
-    discovered_plugins = entry_points(name=decoder_id, group="pysigrok.decoders")
+    discovered_plugins = _all_decoders().get(decoder_id, [])
     if len(discovered_plugins) == 1:
         return discovered_plugins[0].load()
+    if not discovered_plugins:
+        raise RuntimeError("Unknown decoder id: " + decoder_id)
     raise RuntimeError(
-        "Decoder id ambiguous:" + ",".join([p.name for p in discovered_plugins])
+        "Decoder id ambiguous:" + ",".join([p.value for p in discovered_plugins])
     )
 
 
+def _compile_cond(cond):
+    """
+    Compile a wait() condition dict into ``(skip, level_mask, level, edge_mask,
+    edge)``. ``skip`` is the skip count or None. A sample pair matches when
+    ``current & level_mask == level`` and ``(last ^ current) & edge_mask == edge``,
+    which tests every channel at once.
+    """
+    skip = None
+    level_mask = level = edge_mask = edge = 0
+    for channel, state in cond.items():
+        if channel == "skip":
+            skip = state
+            continue
+        mask = 1 << channel
+        if state in ("h", "r"):
+            level_mask |= mask
+            level |= mask
+        elif state in ("l", "f"):
+            level_mask |= mask
+        if state in ("r", "f", "e"):
+            edge_mask |= mask
+            edge |= mask
+        elif state == "s":
+            edge_mask |= mask
+    return skip, level_mask, level, edge_mask, edge
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_conds_fn(conds):
+    """
+    Generate a ``match(current_sample, changed)`` function for a set of conditions.
+    ``conds`` is a tuple of ``(bit, level_mask, level, edge_mask, edge)`` with the
+    masks from _compile_cond(). The function returns an int with ``1 << bit`` set
+    for each condition that matches. ``changed`` is ``last_sample ^
+    current_sample``. The masks are inlined as constants so each distinct set of
+    conditions gets its own specialized function.
+    """
+    always = 0
+    body = []
+    for bit, level_mask, level, edge_mask, edge in conds:
+        terms = []
+        if level_mask:
+            terms.append(f"current_sample & {level_mask:#x} == {level:#x}")
+        if edge_mask:
+            terms.append(f"changed & {edge_mask:#x} == {edge:#x}")
+        if not terms:
+            always |= 1 << bit
+            continue
+        body.append(f"    if {' and '.join(terms)}:")
+        body.append(f"        matched |= {1 << bit:#x}")
+    source = "\n".join(
+        [
+            "def match(current_sample, changed):",
+            f"    matched = {always:#x}",
+            *body,
+            "    return matched",
+            "",
+        ]
+    )
+    namespace = {}
+    exec(compile(source, "<wait conditions>", "exec"), namespace)
+    return namespace["match"]
+
+
 def cond_matches(cond, last_sample, current_sample):
+    # Drivers call this once per sample, often with fresh condition dicts, so it
+    # tests the dict directly. Compiling or caching costs more than it saves here.
     matches = True
     for channel in cond:
         if channel == "skip":
@@ -212,12 +395,122 @@ def cond_matches(cond, last_sample, current_sample):
     return matches
 
 
+def _output_callback(output, source, lock=None):
+    # A closure over the bound method is cheaper to call than functools.partial.
+    output_fn = output.output
+
+    if lock is None:
+
+        def callback(startsample, endsample, data):
+            output_fn(source, startsample, endsample, data)
+
+    else:
+
+        def callback(startsample, endsample, data):
+            with lock:
+                output_fn(source, startsample, endsample, data)
+
+    return callback
+
+
+# Number of events handed from one decoder thread to the next at a time when
+# run_decoders() is threaded.
+PIPELINE_BATCH_SIZE = 256
+
+
+class _DecoderThread:
+    """
+    Runs a stacked decoder's decode() on its own thread. Events from the decoder
+    below are batched into a bounded queue so neither side waits on the other for
+    every event.
+    """
+
+    def __init__(self, decoder):
+        # Imported here so unthreaded runs don't load them.
+        import queue
+        import threading
+
+        self.decoder = decoder
+        self._thread = threading.Thread(
+            target=self._run, name=f"pysigrok-{type(decoder).__name__}", daemon=True
+        )
+        self._queue = queue.Queue(maxsize=16)
+        self._batch = []
+        self._error = None
+        self._discard = False
+
+    def decode(self, startsample, endsample, data):
+        if self._discard:
+            return
+        self._batch.append((startsample, endsample, data))
+        if len(self._batch) >= PIPELINE_BATCH_SIZE:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def start(self):
+        self._thread.start()
+
+    def _run(self):
+        decode = self.decoder.decode
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            # Keep draining after an error or close() so the decoder below never
+            # blocks.
+            if self._error is not None or self._discard:
+                continue
+            try:
+                for startsample, endsample, data in batch:
+                    decode(startsample, endsample, data)
+            except Exception as error:
+                self._error = error
+
+    def finish(self):
+        """Decode any remaining events, wait for the thread and re-raise its error."""
+        if self._batch:
+            self._queue.put(self._batch)
+            self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """Stop the thread, if it is still running, without decoding queued events."""
+        if not self._thread.is_alive():
+            return
+        self._discard = True
+        self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+
+
 def run_decoders(
-    input_, output, decoders=[], output_type=OUTPUT_ANN, output_filter=None
+    input_,
+    output,
+    decoders=[],
+    output_type=OUTPUT_ANN,
+    output_filter=None,
+    threaded=False,
 ):
-    input_.add_callback(OUTPUT_PYTHON, None, functools.partial(output.output, input_))
+    """
+    Decode ``input_`` with the stack of ``decoders`` and send the results to
+    ``output``. When ``threaded`` is set, each stacked decoder runs on its own
+    thread. Every decoder still sees its events in order, but output calls from
+    different decoders may interleave differently than when run unthreaded.
+    """
+    output_lock = None
+    if threaded:
+        import threading
+
+        output_lock = threading.Lock()
+    input_.add_callback(
+        OUTPUT_PYTHON, None, _output_callback(output, input_, output_lock)
+    )
 
     all_decoders = []
+    threads = {}
     next_decoder = None
     for decoder_info in reversed(decoders):
         decoder_class = decoder_info["cls"]
@@ -230,10 +523,15 @@ def run_decoders(
             decoder.set_channelnum(decoder_id, channelnum)
 
         decoder.add_callback(
-            output_type, output_filter, functools.partial(output.output, decoder)
+            output_type, output_filter, _output_callback(output, decoder, output_lock)
         )
         if next_decoder:
-            decoder.add_callback(output_type, output_filter, next_decoder.decode)
+            if threaded:
+                thread = _DecoderThread(next_decoder)
+                threads[id(next_decoder)] = thread
+                decoder.add_callback(output_type, output_filter, thread.decode)
+            else:
+                decoder.add_callback(output_type, output_filter, next_decoder.decode)
         next_decoder = decoder
         output_type = OUTPUT_PYTHON
         output_filter = None
@@ -254,9 +552,25 @@ def run_decoders(
     output.start()
     for d in all_decoders:
         d.start()
+    try:
+        for thread in threads.values():
+            thread.start()
 
-    first_decoder.run(input_)
+        first_decoder.run(input_)
 
-    for d in all_decoders:
-        d.stop()
-    output.stop()
+        # Stop in stack order so anything a decoder emits from stop() is decoded by
+        # the next one before that one stops.
+        for d in all_decoders:
+            if id(d) in threads:
+                threads[id(d)].finish()
+            d.stop()
+        output.stop()
+    finally:
+        # Don't leave stage threads blocked on their queues after an error. Every
+        # stage drops its input before any stops, and they stop from the bottom up,
+        # so no stage is left feeding a full queue that nothing drains.
+        stages = list(threads.values())
+        for thread in stages:
+            thread._discard = True
+        for thread in reversed(stages):
+            thread.close()
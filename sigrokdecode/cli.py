@@ -57,6 +57,12 @@ for decoder in decoders:
 @click.option("--samples", type=int)
 @click.option("--frames")
 @click.option("--continuous", is_flag=True)
+@click.option(
+    "--threaded",
+    is_flag=True,
+    default=False,
+    help="run each stacked protocol decoder on its own thread",
+)
 def main(
     list_supported,
     list_serial,
@@ -74,6 +80,7 @@ def main(
     samples,
     frames,
     continuous,
+    threaded,
 ):
     if list_supported:
         print("Supported hardware drivers:")
@@ -239,4 +246,4 @@ def main(
         decoders=decoders,
         **output_options,
     )
-    run_decoders(driver, output, decoders)
+    run_decoders(driver, output, decoders, threaded=threaded)
@@ -8,9 +8,9 @@ class Input:
 
     def add_callback(self, output_type, output_filter, fun):
         if output_type not in self.callbacks:
-            self.callbacks[output_type] = set()
+            self.callbacks[output_type] = []
 
-        self.callbacks[output_type].add((output_filter, fun))
+        self.callbacks[output_type].append((output_filter, fun))
 
     def put(
         self, startsample: int, endsample: int, output_id: OutputType, data: DataType
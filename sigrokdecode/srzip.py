@@ -1,6 +1,8 @@
 import array
+import re
 import zipfile
 import configparser
+import os
 import struct
 import io
 from os import PathLike
@@ -10,10 +12,35 @@ from typing.io import IO
 from .output import Output
 from .input import Input
 
-from . import cond_matches, __version__, OUTPUT_PYTHON
+from . import _compile_cond, _compile_conds_fn, __version__, MatchedMask, OUTPUT_PYTHON
 
 TYPECODE = {1: "B", 2: "H", 4: "L", 5: "Q"}
 
+# Number of samples SrZipInput.wait() scans per block. Override with the
+# PYSIGROK_BLOCK_SIZE environment variable.
+try:
+    BLOCK_SIZE = int(os.environ.get("PYSIGROK_BLOCK_SIZE", 32 * 1024))
+except ValueError:
+    raise ValueError(
+        "PYSIGROK_BLOCK_SIZE must be an integer, not "
+        + repr(os.environ["PYSIGROK_BLOCK_SIZE"])
+    ) from None
+if BLOCK_SIZE < 1:
+    raise ValueError(f"PYSIGROK_BLOCK_SIZE must be at least 1, not {BLOCK_SIZE}")
+
+# Maximum number of distinct sample values to keep unpacked channel tuples for.
+BITS_CACHE_SIZE = 4096
+
+# Runs of repeated samples are only searched with a compiled pattern once they are
+# at least this long. Shorter ones are stepped over one sample at a time.
+SHORT_RUN = 16
+
+# Maximum number of distinct sample values to keep run patterns for.
+RUN_PATTERN_CACHE_SIZE = 256
+
+# Maximum number of distinct wait() condition lists to keep compiled.
+WAIT_CACHE_SIZE = 256
+
 UNITS = {
     "Hz": 1,
     "kHz": 1000,
@@ -88,11 +115,21 @@ class SrZipInput(Input):
             name = metadata.get("device 1", f"analog{total_logic + i + 1}")
             self.analog_channels.append(name)
 
+        # Compiled regular expressions that match a run of one sample value. Used
+        # to jump over unchanging samples without testing each one in Python.
+        self._run_patterns = {}
+        # Channel value tuples returned by wait(), shared between equal samples.
+        self._bits = {}
+        # wait() setups from _compile_wait() keyed by the conditions' contents.
+        self._waits = {}
         if self.single_file:
-            self.data = self.zip.read("logic-1")
+            self._raw = self.zip.read("logic-1")
+            self.data = self._raw
             if self.unitsize > 1:
                 self.data = array.array(self.typecode, self.data)
+            self._file_start = 0
         else:
+            self._raw = None
             self.data = None
             self._file_start = -1
             self._file_index = 1
@@ -108,14 +145,37 @@ class SrZipInput(Input):
             self._analog_chunk_len = len(self._analog_data[0]) // 4
 
     def wait(self, conds=[]):
-        if conds is None:
-            conds = []
-        self.matched = [False]
-        while not any(self.matched):
-            self.matched = [True] * (len(conds) if conds else 1)
-            self.samplenum += 1
-            if self.single_file:
-                if self.samplenum >= len(self.data):
+        key = tuple([tuple(cond.items()) for cond in conds or ()])
+        setup = self._waits.get(key)
+        if setup is None:
+            if len(self._waits) >= WAIT_CACHE_SIZE:
+                self._waits.clear()
+            setup = self._compile_wait(conds)
+            self._waits[key] = setup
+        match, count, skip, skip_bits, skip_only = setup
+        skip_at = None
+        if skip is not None:
+            skip_at = self.samplenum + skip
+            target = skip_at - self._file_start
+            if (
+                skip_only
+                and skip <= SHORT_RUN
+                and self.one_to_one
+                and not self.analog_channels
+                and self.last_sample is not None
+                and self.data is not None
+                and target < len(self.data)
+            ):
+                # Nothing else can match first so go straight to the target.
+                self._skip_to(target)
+                self.matched = MatchedMask(skip_bits, count)
+                return self._sample_bits()
+
+        while True:
+            index = self.samplenum + 1 - self._file_start
+            if self.data is None or index >= len(self.data):
+                if self.single_file or not self._load_next_file():
+                    self.samplenum += 1
                     self.put(
                         self.start_samplenum,
                         self.samplenum,
@@ -123,70 +183,197 @@ class SrZipInput(Input):
                         ["logic", self.last_sample],
                     )
                     raise EOFError()
-                sample = self.data[self.samplenum]
-            else:
-                file_samplenum = self.samplenum - self._file_start
-                if self.data is None or file_samplenum >= len(self.data):
-                    self._file_start = self.samplenum
-                    try:
-                        self.data = self.zip.read(f"logic-1-{self._file_index:d}")
-                    except KeyError:
-                        self.put(
-                            self.start_samplenum,
-                            self.samplenum,
-                            OUTPUT_PYTHON,
-                            ["logic", self.last_sample],
-                        )
-                        raise EOFError()
-
-                    if self.unitsize > 1:
-                        self.data = array.array(self.typecode, self.data)
-
-                    file_samplenum = 0
-                    self._file_index += 1
-                sample = self.data[file_samplenum]
-
-            if not self.one_to_one:
+                index = 0
+            stop = min(index + BLOCK_SIZE, len(self.data))
+            end = self._scan_block(match, count, skip_at, skip_bits, index, stop)
+            if end < stop:
+                break
+        return self._sample_bits()
+
+    def _compile_wait(self, conds):
+        """
+        Compile wait() conditions into ``(match, count, skip, skip_bits,
+        skip_only)``. ``match`` is the _compile_conds_fn() function for the
+        conditions without a skip. ``skip`` is the smallest positive skip count, or
+        None, and ``skip_bits`` has the bits of the conditions with that skip.
+        ``skip_only`` is True when every condition has a skip.
+        """
+        if not conds:
+            # Without conditions the next sample matches.
+            conds = [{}]
+        conds = [_compile_cond(cond) for cond in conds]
+        # Skip conditions match a fixed number of samples from now. Only the
+        # smallest can be reached before wait() returns.
+        skip = None
+        skip_bits = 0
+        for bit, compiled in enumerate(conds):
+            if compiled[0] is None or compiled[0] <= 0:
+                continue
+            if skip is None or compiled[0] < skip:
+                skip = compiled[0]
+                skip_bits = 0
+            if compiled[0] == skip:
+                skip_bits |= 1 << bit
+        level_conds = tuple(
+            (bit, *compiled[1:])
+            for bit, compiled in enumerate(conds)
+            if compiled[0] is None
+        )
+        match = _compile_conds_fn(level_conds)
+        return match, len(conds), skip, skip_bits, not level_conds
+
+    def _skip_to(self, target):
+        """
+        Move to the loaded sample at index ``target``, putting the logic values
+        changed along the way. Only used without analog channels or bit remapping.
+        """
+        data = self.data
+        file_start = self._file_start
+        last = self.last_sample
+        for i in range(self.samplenum + 1 - file_start, target + 1):
+            sample = data[i]
+            if sample != last:
+                samplenum = file_start + i
+                self.samplenum = samplenum
+                self.put(
+                    self.start_samplenum,
+                    samplenum,
+                    OUTPUT_PYTHON,
+                    ["logic", last],
+                )
+                self.start_samplenum = samplenum
+                last = sample
+        self.samplenum = file_start + target
+        self.last_sample = last
+
+    def _sample_bits(self):
+        """Return the channel values of the current sample."""
+        sample = self.last_sample
+        bits = self._bits.get(sample)
+        if bits is None:
+            if len(self._bits) >= BITS_CACHE_SIZE:
+                self._bits.clear()
+            bits = tuple((sample >> b) & 0x1 for b in range(self.unitsize * 8))
+            self._bits[sample] = bits
+        return bits
+
+    def _load_next_file(self):
+        try:
+            self._raw = self.zip.read(f"logic-1-{self._file_index:d}")
+        except KeyError:
+            return False
+        self._file_start = self.samplenum + 1
+        self._file_index += 1
+        self.data = self._raw
+        if self.unitsize > 1:
+            self.data = array.array(self.typecode, self.data)
+        return True
+
+    def _scan_block(self, match, count, skip_at, skip_bits, start, stop):
+        """
+        Scan the loaded samples from ``start`` up to ``stop`` and return the index of
+        the first one that matches, or ``stop`` if none do. ``match`` tests the
+        ``count`` conditions' channels and ``skip_bits`` are added to the matches at
+        sample number ``skip_at``. Logic and analog values are put along the way.
+        """
+        data = self.data
+        file_start = self._file_start
+        bit_mapping = None if self.one_to_one else self.bit_mapping
+        analog = bool(self.analog_channels)
+        # Once a sample repeats, every following copy of it evaluates the same way
+        # so the rest of the run can be jumped over, up to any skip target. That
+        # isn't possible when analog values need putting for every sample.
+        jump = not analog
+        jump_stop = stop
+        if skip_at is not None:
+            jump_stop = min(stop, skip_at - file_start)
+        last = self.last_sample
+        i = start
+        while i < stop:
+            sample = data[i]
+            if bit_mapping is not None:
                 mapped_sample = 0
-                for in_bit, out_bit in self.bit_mapping:
+                for in_bit, out_bit in bit_mapping:
                     if sample & (1 << in_bit) != 0:
                         mapped_sample |= 1 << out_bit
                 sample = mapped_sample
 
-            if self.last_sample is None:
-                self.last_sample = sample
-                self.start_samplenum = self.samplenum
+            samplenum = file_start + i
+            if last is None:
+                last = sample
+                self.start_samplenum = samplenum
 
-            if self.last_sample != sample:
+            if last != sample:
+                self.samplenum = samplenum
                 self.put(
                     self.start_samplenum,
-                    self.samplenum,
+                    samplenum,
                     OUTPUT_PYTHON,
-                    ["logic", self.last_sample],
+                    ["logic", last],
                 )
-                self.start_samplenum = self.samplenum
+                self.start_samplenum = samplenum
 
-            if self.analog_channels:
+            if analog:
+                self.samplenum = samplenum
                 self.put(
-                    self.samplenum,
-                    self.samplenum + 1,
+                    samplenum,
+                    samplenum + 1,
                     OUTPUT_PYTHON,
-                    ["analog"] + self.get_analog_values(self.samplenum),
+                    ["analog"] + self.get_analog_values(samplenum),
                 )
 
-            for i, cond in enumerate(conds):
-                if "skip" in cond:
-                    cond["skip"] -= 1
-                    self.matched[i] = cond["skip"] == 0
-                    continue
-                self.matched[i] = cond_matches(cond, self.last_sample, sample)
-            self.last_sample = sample
+            matched = match(sample, last ^ sample)
+            if samplenum == skip_at:
+                matched |= skip_bits
 
-        bits = []
-        for b in range(self.unitsize * 8):
-            bits.append((sample >> b) & 0x1)
+            if matched:
+                self.samplenum = samplenum
+                self.last_sample = sample
+                self.matched = MatchedMask(matched, count)
+                return i
 
-        return tuple(bits)
+            if jump and sample == last:
+                i = self._run_end(i, jump_stop)
+            else:
+                i += 1
+            last = sample
+
+        if stop > start:
+            self.samplenum = file_start + stop - 1
+        self.last_sample = last
+        return stop
+
+    def _run_end(self, index, stop):
+        """
+        Return the index after the run of samples equal to ``self.data[index]``,
+        searching no further than ``stop``.
+        """
+        data = self.data
+        sample = data[index]
+        short_stop = min(index + SHORT_RUN, stop)
+        index += 1
+        while index < short_stop:
+            if data[index] != sample:
+                return index
+            index += 1
+        if index >= stop:
+            return stop
+
+        unitsize = self.unitsize
+        start = index * unitsize
+        unit = self._raw[start - unitsize : start]
+        pattern = self._run_patterns.get(unit)
+        if pattern is None:
+            if len(self._run_patterns) >= RUN_PATTERN_CACHE_SIZE:
+                self._run_patterns.clear()
+            if unit.count(unit[:1]) == unitsize:
+                # A run of repeated bytes is much faster to match than a repeated
+                # group. Rounding down drops a partial sample at the end.
+                pattern = re.compile(re.escape(unit[:1]) + b"*")
+            else:
+                pattern = re.compile(b"(?:" + re.escape(unit) + b")*")
+            self._run_patterns[unit] = pattern
+        return pattern.match(self._raw, start, stop * unitsize).end() // unitsize
 
     def get_analog_values(self, samplenum):
         if samplenum >= (self._analog_offset + self._analog_chunk_len):